@@ -0,0 +1,115 @@
+import atexit
+import functools
+import logging
+import logging.handlers
+import queue
+import socket
+
+# Helpers shared by the web server and the proxy server.
+
+SOCKET_BUFFER_SIZE = 262144  # Kernel send/receive buffer size for every connection.
+
+# Python already creates every socket non-inheritable, atomically via
+# SOCK_CLOEXEC on Linux (PEP 446). Passing the flag here changes nothing at
+# runtime; it only makes that default explicit for the listening sockets.
+LISTEN_SOCKET_TYPE = socket.SOCK_STREAM | getattr(socket, "SOCK_CLOEXEC", 0)
+
+# Receive buffers are pooled and reused across requests instead of letting every
+# recv() allocate a fresh bytes object, which keeps heap churn off the hot path.
+BUF_SIZE = 65536
+BUF_POOL = queue.LifoQueue()
+_ZEROS = memoryview(bytes(BUF_SIZE))
+
+def acquire_buffer():
+    # Take a buffer from the pool, or allocate one if the pool is empty.
+    try:
+        return BUF_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray(BUF_SIZE)
+
+def release_buffer(buf, used):
+    # Wipe the bytes that were used so no request data outlives its request,
+    # then hand the buffer back to the pool.
+    buf[:used] = _ZEROS[:used]
+    BUF_POOL.put(buf)
+
+def recv_request_head(sock, buf):
+    # Receive into buf until the blank line ending the request headers arrives,
+    # since a request can be split across several TCP segments. Returns the
+    # number of bytes received; 0 means the client sent nothing before closing.
+    # Stops early if the client closes mid-request or the buffer fills up, in
+    # which case the caller sees (and rejects) an incomplete request.
+    view = memoryview(buf)
+    received = 0
+    try:
+        while received < len(buf):
+            n = sock.recv_into(view[received:])
+            if n == 0:
+                break
+            # The terminator may straddle two reads, so look back 3 bytes. Bare-LF
+            # line endings ("\n\n") are accepted too, as lenient clients send them.
+            start = max(0, received - 3)
+            received += n
+            if buf.find(b"\r\n\r\n", start, received) >= 0 or buf.find(b"\n\n", start, received) >= 0:
+                break
+    finally:
+        view.release()
+    return received
+
+# Only request lines up to this length are memoized. The cache key is the raw,
+# client-controlled line, so caching arbitrarily long lines would let a client
+# pin large amounts of memory; normal request lines are far shorter than this.
+MAX_CACHED_REQUEST_LINE = 64
+
+def parse_request_line(request_line):
+    # Split a request line like b"GET /500 HTTP/1.1" into (method, path,
+    # version, size), where size is the document size named by the path or
+    # None if the path isn't a number. An absolute URI ("http://host/500") is
+    # reduced to its path. Returns None if the line is malformed.
+    # Clients request the same few URIs over and over, so short lines are
+    # memoized and a repeated request line costs a single dict lookup.
+    if len(request_line) <= MAX_CACHED_REQUEST_LINE:
+        return _parse_request_line_cached(request_line)
+    return _parse_request_line(request_line)
+
+def _parse_request_line(request_line):
+    parts = request_line.split(b" ", 2)
+    if len(parts) < 3:
+        return None
+    method, path, version = parts
+    if path.startswith(b"http://"):
+        path = path[len(b"http://"):]
+        path = path[path.find(b"/"):]
+    try:
+        size = int(path.lstrip(b"/"))
+    except ValueError:
+        size = None
+    return method, path, version, size
+
+_parse_request_line_cached = functools.lru_cache(maxsize=4096)(_parse_request_line)
+
+def tune_socket(sock):
+    # Disable Nagle's algorithm so small writes (like response headers) go out
+    # immediately instead of waiting up to 40ms for more data, and enlarge the
+    # kernel buffers so large responses need fewer round trips through send/recv.
+    # Accepted sockets inherit these options from the listening socket on Linux,
+    # but we also set them per connection for platforms that don't.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+def setup_logging(level=logging.INFO):
+    # Route log records through a queue: handler threads only enqueue records
+    # and one background thread writes them out, so worker threads never
+    # contend for the stream handler's lock. Safe to call more than once.
+    root = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(threadName)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on exit.
@@ -1,162 +1,473 @@
+import collections
+import concurrent.futures
+import hashlib
 import socket
 import threading
 import logging
 import os
+import queue
+import re
+import tempfile
 import time
 
+from httpCommon import (
+    LISTEN_SOCKET_TYPE,
+    acquire_buffer,
+    parse_request_line,
+    recv_request_head,
+    release_buffer,
+    setup_logging,
+    tune_socket,
+)
+
 # Setting up logging to help us debug and monitor the proxy server's behavior.
-# INFO level is used to log important events like incoming connections and responses.
-logging.basicConfig(level=logging.INFO, format='%(threadName)s: %(message)s')
+# INFO level is used to log important events like the server starting; per-request
+# events are logged at DEBUG so they stay off the hot path unless asked for.
+setup_logging()
+log = logging.getLogger(__name__)
+
+# Handler threads only run a short recv/forward/send sequence, so the default
+# 8MB stack reservation per thread is wasted; a small stack lets many more
+# connections be served concurrently for the same memory.
+threading.stack_size(256 * 1024)
+
+# Bodiless status responses are formatted once up front instead of on every
+# error reply. send_response is kept for replies that carry content.
+RESP_304 = b"HTTP/1.1 304 Not Modified\r\nContent-Type: text/html\r\nContent-Length: 0\r\n\r\n"
+RESP_400 = b"HTTP/1.1 400 Bad Request\r\nContent-Type: text/html\r\nContent-Length: 0\r\n\r\n"
+RESP_404 = b"HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\nContent-Length: 0\r\n\r\n"
+RESP_414 = b"HTTP/1.1 414 Request-URI Too Long\r\nContent-Type: text/html\r\nContent-Length: 0\r\n\r\n"
+RESP_501 = b"HTTP/1.1 501 Not Implemented\r\nContent-Type: text/html\r\nContent-Length: 0\r\n\r\n"
+
+CACHE_FILENAME_RE = re.compile(r"[0-9a-f]{32}")  # What cache_key produces.
+HTTP_VERSION_RE = re.compile(rb"HTTP/[0-9]\.[0-9]")  # A well-formed request-line version.
+
+def content_length(head):
+    # Return the Content-Length of an HTTP message head, or None if it has none.
+    # A malformed value is reported as a connection error, since the message
+    # can't be framed and the connection can't be reused.
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            try:
+                length = int(value)
+            except ValueError:
+                raise ConnectionError("malformed Content-Length: %r" % value) from None
+            if length < 0:
+                raise ConnectionError("negative Content-Length: %d" % length)
+            return length
+    return None
 
 class ProxyServer:
     CACHE_DIR = "proxy_cache"  # Directory to store cached responses.
-    CACHE_SIZE_LIMIT = 10       # Maximum number of cached items.
+    CACHE_BYTE_LIMIT = 64 * 1024 * 1024  # Maximum total size of cached responses, in bytes.
+    CACHE_POLICY = "lru"        # Eviction policy: "lru" or "fifo" (kept for A/B comparison).
+    MAX_WORKERS = 128           # Maximum number of connections handled concurrently.
+    MAX_QUEUED = 128            # Accepted connections allowed to wait for a free worker.
+    CLIENT_TIMEOUT = 5          # Seconds to wait on a silent or stalled client.
+    UPSTREAM_TIMEOUT = 5        # Seconds to wait on a stalled web server.
 
     def __init__(self, host='0.0.0.0', port=8888, web_server_host='localhost', web_server_port=8080):
         self.host = host
         self.port = port
         self.web_server_host = web_server_host  # Target web server hostname or IP.
         self.web_server_port = web_server_port  # Target web server port.
-        self.cache = {}  # Dictionary to map URIs to cache file names.
-        # Using a dictionary for caching because it provides fast lookups.
+        self.cache = collections.OrderedDict()  # Map cache file names to response sizes in bytes.
+        # An OrderedDict gives fast lookups and keeps entries in eviction order:
+        # the first entry is always the next one to evict. Entries are keyed by
+        # file name (see cache_key) so the cache can be rebuilt from disk.
+        self._bytes = 0   # Total size of all cached responses.
+        self._lock = threading.Lock()
+        # handle_client runs in many threads at once, so every read or write of
+        # the cache dictionary (and the matching file removals) happens under
+        # this lock. It is never held across network I/O.
+        self._pending = {}  # Responses fetched but not yet written to the cache directory, by file name.
+        self._upstream_pool = queue.LifoQueue(maxsize=64)  # Idle keep-alive connections to the web server.
+        # Connections are handled by a fixed set of reused worker threads, which
+        # bounds resource usage and keeps thread creation off the accept path.
+        # Extra connections wait in the executor's queue until a worker frees up.
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix='proxy')
+        # The executor's own queue is unbounded, so admission is capped with a
+        # semaphore: once every worker is busy and MAX_QUEUED connections are
+        # waiting, the accept loop stops and new connections wait in the kernel.
+        self._slots = threading.BoundedSemaphore(self.MAX_WORKERS + self.MAX_QUEUED)
+        # Cache files are written by a separate small pool after the client has
+        # been served.
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='proxy-io')
+
+        # Cache file paths are built by plain concatenation with this prefix,
+        # which is cheaper than calling os.path.join on every request.
+        self._cache_dir_prefix = self.CACHE_DIR.rstrip("/") + "/"
 
         # Create the cache directory if it doesn't exist.
         if not os.path.exists(self.CACHE_DIR):
             os.makedirs(self.CACHE_DIR)
+        else:
+            self.load_cache()  # Reuse responses cached by a previous run.
+
+    def load_cache(self):
+        # Rebuild the cache from the files left in the cache directory, so a
+        # restart doesn't lose what was already cached. Files are added oldest
+        # first so the eviction order roughly matches when they were cached.
+        entries = []
+        for entry in os.scandir(self.CACHE_DIR):
+            if not entry.is_file():
+                continue
+            if not self.is_cache_filename(entry.name):
+                # Left over from an interrupted write or an older naming scheme;
+                # such files can never be looked up again.
+                os.remove(entry.path)
+                continue
+            entries.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+
+        with self._lock:
+            for _, filename, size in sorted(entries):
+                self.cache[filename] = size
+                self._bytes += size
+            while self.is_cache_full():
+                self.evict_cache()
 
     def cache_key(self, uri):
-        # Generate a file-safe key from the URI by replacing slashes with underscores.
-        return uri.replace("/", "_")
+        # Generate a file-safe key from the URI. Hashing (rather than escaping
+        # characters) gives short fixed-length names, can't collide for distinct
+        # URIs the way "/a/b" and "/a_b" did, and can't escape CACHE_DIR.
+        return hashlib.blake2b(uri.encode('ascii'), digest_size=16).hexdigest()
+
+    def is_cache_filename(self, filename):
+        # Check whether a file name could have been produced by cache_key:
+        # exactly 32 lowercase hex digits.
+        return CACHE_FILENAME_RE.fullmatch(filename) is not None
 
     def is_cache_full(self):
-        # Check if the cache has reached its size limit.
-        # This is important to prevent using too many resources.
-        return len(self.cache) >= self.CACHE_SIZE_LIMIT
+        # Caller must hold self._lock.
+        # Check if the cached responses exceed the byte budget. Budgeting by
+        # bytes rather than entries keeps the disk footprint predictable no
+        # matter how large individual responses are.
+        return self._bytes > self.CACHE_BYTE_LIMIT
+
+    def touch_cache(self, cache_filename):
+        # Caller must hold self._lock.
+        # Mark a cache entry as recently used. Under LRU this moves it to the end
+        # of the eviction order; under FIFO the insertion order is left alone.
+        if self.CACHE_POLICY == "lru":
+            self.cache.move_to_end(cache_filename)
 
     def evict_cache(self):
-        # Remove the oldest cached item to make space for new entries.
-        # We use a simple first-in first-out (FIFO) method.
+        # Caller must hold self._lock.
+        # Remove the item at the front of the eviction order to make space for
+        # new entries: the least recently used one (LRU) or the oldest one (FIFO).
         if self.cache:
-            oldest_key = next(iter(self.cache))  # Get the first key in the cache (oldest).
-            filepath = os.path.join(self.CACHE_DIR, self.cache[oldest_key])
+            filename, size = self.cache.popitem(last=False)
+            self._bytes -= size
+            filepath = self._cache_dir_prefix + filename
             if os.path.exists(filepath):
                 os.remove(filepath)  # Remove the file from the filesystem.
-            del self.cache[oldest_key]  # Remove the entry from the cache dictionary.
 
     def handle_client(self, client_socket):
-        # Handle an incoming client connection.
+        # Handle an incoming client connection. The timeout keeps an idle or
+        # stalled client from holding one of the bounded worker threads forever.
+        buf = acquire_buffer()
+        view = memoryview(buf)
+        used = 0
         try:
+            client_socket.settimeout(self.CLIENT_TIMEOUT)
             # Receive the HTTP request from the client.
-            request = client_socket.recv(1024).decode('utf-8')
-            logging.info(f"Proxy received request: {request}")
-
-            # Parse the request lines.
-            lines = request.splitlines()
-            if not lines:
+            used = recv_request_head(client_socket, buf)
+            if not used:
                 return
 
-            request_line = lines[0]
-            parts = request_line.split()
-            if len(parts) < 3:
+            # Parse the request line straight from the receive buffer instead of
+            # decoding and splitting the whole request.
+            # Lines may end in CRLF or a bare LF.
+            line_end = buf.find(b"\n", 0, used)
+            request_line = bytes(view[:line_end if line_end >= 0 else used]).rstrip(b"\r")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Proxy received request: %s", request_line.decode('latin-1'))
+
+            # The parser also removes "http://host" from absolute URIs.
+            parsed = parse_request_line(request_line)
+            if parsed is None:
                 # Respond with 400 Bad Request if the request line is invalid.
-                self.send_response(client_socket, 400, "Bad Request")
+                client_socket.sendall(RESP_400)
                 return
 
-            method, uri, version = parts
+            method, target, version, size = parsed
 
-            # Only support GET requests; respond with 501 Not Implemented for others.
-            if method != "GET":
-                self.send_response(client_socket, 501, "Not Implemented")
+            # The version must be a single HTTP/x.y token; anything else (extra
+            # words, stray line feeds) is rejected so it can't leak upstream.
+            if HTTP_VERSION_RE.fullmatch(version) is None:
+                client_socket.sendall(RESP_400)
                 return
 
-            # Remove "http://" from the URI to get the relative path.
-            if uri.startswith("http://"):
-                uri = uri[len("http://"):]
-                uri = uri[uri.find("/"):]
+            # Only support GET requests; respond with 501 Not Implemented for others.
+            if method != b"GET":
+                client_socket.sendall(RESP_501)
+                return
 
-            # Validate the URI format.
+            # Validate the URI format. Only the URI is decoded, since the cache is
+            # keyed by it.
+            try:
+                uri = target.decode('ascii')
+            except UnicodeDecodeError:
+                uri = ""
             if not uri.startswith("/"):
-                self.send_response(client_socket, 400, "Bad Request")
+                client_socket.sendall(RESP_400)
                 return
 
             # Generate the cache file path for this URI.
             cache_filename = self.cache_key(uri)
-            cache_filepath = os.path.join(self.CACHE_DIR, cache_filename)
+            cache_filepath = self._cache_dir_prefix + cache_filename
 
             # Check if the URI is already in the cache.
-            if uri in self.cache:
+            cached = False
+            cached_file = None
+            pending_response = None
+            with self._lock:
+                if cache_filename in self.cache:
+                    cached = True
+                    self.touch_cache(cache_filename)
+                    if len(uri) % 2 == 0:
+                        # Open the file while holding the lock so it can't be evicted
+                        # between the lookup and the open. Once open, it can still be
+                        # streamed even if it is removed afterwards.
+                        try:
+                            cached_file = open(cache_filepath, "rb")
+                        except FileNotFoundError:
+                            # The file is gone; drop the stale entry and fetch again.
+                            self._bytes -= self.cache.pop(cache_filename)
+                            cached = False
+                elif cache_filename in self._pending:
+                    # Fetched but not written to disk yet: serve it from memory.
+                    cached = True
+                    pending_response = self._pending[cache_filename]
+
+            if cached:
                 # Serve cached responses to reduce latency and network overhead.
-                file_length = len(self.cache[uri])
-                if file_length % 2 == 1:  # Odd-length content: simulate "Not Modified".
-                    self.send_response(client_socket, 304, "Not Modified")
+                if len(uri) % 2 == 1:  # Odd-length URI: simulate "Not Modified".
+                    client_socket.sendall(RESP_304)
                     return
 
-            # Simulate additional URI-based validation.
-            try:
-                size = int(uri[1:])
-                if size > 9999:
-                    # Respond with 414 Request-URI Too Long if the size is too large.
-                    self.send_response(client_socket, 414, "Request-URI Too Long")
+                if cached_file is None:
+                    client_socket.sendall(pending_response)
                     return
-            except ValueError:
+
+                # The cache file holds the complete upstream response, status line
+                # and headers included, so stream it straight from the page cache
+                # into the client socket.
+                with cached_file:
+                    client_socket.sendfile(cached_file)
+                return
+
+            # Simulate additional URI-based validation.
+            if size is None:
                 # Respond with 400 Bad Request if the URI can't be parsed as an integer.
-                self.send_response(client_socket, 400, "Bad Request")
+                client_socket.sendall(RESP_400)
+                return
+            if size > 9999:
+                # Respond with 414 Request-URI Too Long if the size is too large.
+                client_socket.sendall(RESP_414)
                 return
 
-            # Forward the request to the target web server.
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as web_server_socket:
-                try:
-                    # Create a new socket connection for each request.
-                    web_server_socket.connect((self.web_server_host, self.web_server_port))
-                    web_request = f"GET {uri} {version}\r\nHost: {self.web_server_host}:{self.web_server_port}\r\n\r\n"
-                    web_server_socket.sendall(web_request.encode('utf-8'))
-
-                    # Receive the response from the web server.
-                    response = web_server_socket.recv(4096)
-                    logging.info(f"Proxy received response from web server")
-
-                    # Cache the response if the cache is not full.
-                    if self.is_cache_full():
-                        self.evict_cache()
-
-                    with open(cache_filepath, "wb") as f:
-                        f.write(response)  # Save the response to the cache.
-                    self.cache[uri] = cache_filename
-
-                    # Send the response back to the client.
-                    client_socket.sendall(response)
-                except ConnectionRefusedError:
-                    # Respond with 404 Not Found if the target web server is unavailable.
-                    self.send_response(client_socket, 404, "Not Found")
+            # Forward the request to the target web server over a pooled
+            # keep-alive connection. The request is rebuilt from the validated
+            # size rather than copying client bytes, and is always HTTP/1.1 since
+            # the response framing relies on it.
+            web_request = b"GET /%d HTTP/1.1\r\nHost: %s:%d\r\nConnection: keep-alive\r\n\r\n" % (
+                size, self.web_server_host.encode('ascii'), self.web_server_port
+            )
+            try:
+                response = self.fetch_upstream(web_request)
+            except OSError:
+                # Respond with 404 Not Found if the target web server is unavailable
+                # or didn't send a complete response.
+                client_socket.sendall(RESP_404)
+                return
+            log.debug("Proxy received response from web server")
+
+            # Publish the response to concurrent requests and hand it to the
+            # background writer before sending, so a slow or vanished client
+            # neither delays nor prevents caching, and disk I/O stays off the
+            # response path.
+            with self._lock:
+                self._pending[cache_filename] = response
+            self._io_pool.submit(self.persist_cache, uri, cache_filename, cache_filepath, response)
+            client_socket.sendall(response)
+        except OSError:
+            # Client timed out or went away.
+            pass
         finally:
+            view.release()
+            release_buffer(buf, used)
             client_socket.close()
 
+    def connection_done(self, future):
+        # Called when handle_client finishes: free the connection's slot and log
+        # any unexpected error, which the Future would otherwise swallow.
+        self._slots.release()
+        exc = future.exception()
+        if exc is not None:
+            log.error("Error handling connection", exc_info=exc)
+
+    def persist_cache(self, uri, cache_filename, cache_filepath, response):
+        # Save a response to the cache directory and record it in the cache.
+        # Runs on the I/O pool once the client has already been answered.
+        tmp_filepath = None
+        try:
+            # Write to a temporary file and rename it into place so concurrent
+            # writers for the same URI never see each other's partial data.
+            fd, tmp_filepath = tempfile.mkstemp(dir=self.CACHE_DIR, prefix=".tmp")
+            with open(fd, "wb") as f:
+                f.write(response)
+            os.replace(tmp_filepath, cache_filepath)
+        except OSError:
+            log.exception("Failed to cache response for %s", uri)
+            # Don't leave a partial temporary file behind (e.g. on a full disk).
+            if tmp_filepath is not None:
+                try:
+                    os.remove(tmp_filepath)
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._pending.pop(cache_filename, None)
+            return
+
+        # Record the new entry, then evict until the cache is back under budget.
+        # A response larger than the whole budget is evicted right away.
+        with self._lock:
+            self._pending.pop(cache_filename, None)
+            if cache_filename in self.cache:
+                self._bytes -= self.cache.pop(cache_filename)
+            self.cache[cache_filename] = len(response)
+            self._bytes += len(response)
+            while self.is_cache_full():
+                self.evict_cache()
+
+    def get_upstream(self):
+        # Take an idle keep-alive connection to the web server from the pool, or
+        # open a new one. Also report whether the connection was reused.
+        try:
+            return self._upstream_pool.get_nowait(), True
+        except queue.Empty:
+            # The timeout covers connecting and every later read or write; pooled
+            # connections keep it, so a stalled web server cannot pin a worker.
+            upstream_socket = socket.create_connection(
+                (self.web_server_host, self.web_server_port), timeout=self.UPSTREAM_TIMEOUT)
+            tune_socket(upstream_socket)
+            return upstream_socket, False
+
+    def release_upstream(self, upstream_socket):
+        # Return a connection to the pool for the next request, closing it if the
+        # pool already holds enough idle connections.
+        try:
+            self._upstream_pool.put_nowait(upstream_socket)
+        except queue.Full:
+            upstream_socket.close()
+
+    def fetch_upstream(self, request):
+        # Send a request to the web server and return its complete response.
+        # Reusing connections saves a TCP handshake and slow start per request.
+        while True:
+            upstream_socket, reused = self.get_upstream()
+            try:
+                upstream_socket.sendall(request)
+                response, keep_alive = self.read_http_response(upstream_socket)
+            except OSError:
+                upstream_socket.close()
+                if reused:
+                    continue  # The web server may have closed the idle connection; retry.
+                raise
+
+            if keep_alive:
+                self.release_upstream(upstream_socket)
+            else:
+                upstream_socket.close()
+            return response
+
+    def read_http_response(self, upstream_socket):
+        # Read exactly one HTTP response from the web server. Returns the raw
+        # response and whether the connection can carry another request, which is
+        # only the case when Content-Length told us where the response ends.
+        # Raises ConnectionError if the server closes before the response is
+        # complete, so a truncated response is never served or cached.
+        buf = acquire_buffer()
+        view = memoryview(buf)
+        used = 0
+        response = bytearray()
+        try:
+            # Read until the end of the headers.
+            header_end = -1
+            while header_end < 0:
+                n = upstream_socket.recv_into(buf)
+                if n == 0:
+                    raise ConnectionError("web server closed the connection before responding")
+                used = max(used, n)
+                response += view[:n]
+                header_end = response.find(b"\r\n\r\n")
+            header_end += 4
+
+            length = content_length(response[:header_end])
+            if length is None:
+                # Without a Content-Length the body runs until the server closes.
+                while n:
+                    n = upstream_socket.recv_into(buf)
+                    used = max(used, n)
+                    response += view[:n]
+                return response, False
+        finally:
+            view.release()
+            release_buffer(buf, used)
+
+        # Read the rest of the body straight into a buffer of its final size,
+        # never past the end of this response. Large reads into place avoid
+        # both truncation and per-chunk copies.
+        total = header_end + length
+        received = len(response)
+        if received >= total:
+            del response[total:]
+            return response, True
+        full_response = bytearray(total)
+        full_response[:received] = response
+        with memoryview(full_response) as full_view:
+            while received < total:
+                n = upstream_socket.recv_into(full_view[received:])
+                if n == 0:
+                    raise ConnectionError("web server closed the connection mid-response")
+                received += n
+        return full_response, True
+
     def send_response(self, client_socket, status_code, reason, content=""):
         # Send an HTTP response to the client.
         response_line = f"HTTP/1.1 {status_code} {reason}\r\n"
         headers = "Content-Type: text/html\r\n" + f"Content-Length: {len(content)}\r\n\r\n"
         response = response_line + headers + content
         client_socket.sendall(response.encode('utf-8'))
-        logging.info(f"Sent response: {response_line.strip()} with {len(content)} bytes of content")
+        log.info("Sent response: %s with %d bytes of content", response_line.strip(), len(content))
 
     def start(self):
         # Start the proxy server and listen for incoming connections.
-        proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        proxy_socket = socket.socket(socket.AF_INET, LISTEN_SOCKET_TYPE)
         proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Reuse the socket address.
+        tune_socket(proxy_socket)  # Set before listen() so accepted sockets inherit it.
         proxy_socket.bind((self.host, self.port))
-        proxy_socket.listen(5)
-        logging.info(f"Proxy server listening on port {self.port}")
+        # A deep accept backlog keeps bursts of connections (e.g. from wrk) queued
+        # in the kernel instead of being refused while handler threads start up.
+        proxy_socket.listen(socket.SOMAXCONN)
+        log.info("Proxy server listening on port %d", self.port)
 
         try:
             while True:
-                # Accept a client connection.
+                # Wait for a free slot, then accept a client connection.
+                self._slots.acquire()
                 client_socket, client_address = proxy_socket.accept()
-                logging.info(f"Proxy connection from {client_address}")
-                # Handle the client connection in a separate thread.
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
-                client_thread.start()
+                tune_socket(client_socket)
+                log.debug("Proxy connection from %s", client_address)
+                # Handle the client connection on a worker thread.
+                future = self._pool.submit(self.handle_client, client_socket)
+                future.add_done_callback(self.connection_done)
         finally:
             proxy_socket.close()
+            self._pool.shutdown(wait=False)
+            self._io_pool.shutdown(wait=True)  # Finish writing pending cache files.
 
 if __name__ == "__main__":
     proxyServer = ProxyServer()
@@ -1,75 +1,166 @@
+import collections
+import concurrent.futures
 import socket
 import threading
 import logging
 
+from httpCommon import (
+    LISTEN_SOCKET_TYPE,
+    acquire_buffer,
+    parse_request_line,
+    recv_request_head,
+    release_buffer,
+    setup_logging,
+    tune_socket,
+)
+
 # Setting up logging to help us debug and monitor the web server's behavior.
-# INFO level is used to log important events like incoming connections and responses.
-logging.basicConfig(level=logging.INFO, format='%(threadName)s: %(message)s')
+# INFO level is used to log important events like the server starting; per-request
+# events are logged at DEBUG so they stay off the hot path unless asked for.
+setup_logging()
+log = logging.getLogger(__name__)
+
+# Handler threads only parse requests and send responses, so a small stack is
+# plenty and avoids reserving the default 8MB per concurrent connection.
+threading.stack_size(256 * 1024)
 
 class WebServer:
+    KEEP_ALIVE_TIMEOUT = 5  # Seconds an idle keep-alive connection is kept open.
+    MAX_WORKERS = 128       # Maximum number of connections handled concurrently.
+    MAX_QUEUED = 128        # Accepted connections allowed to wait for a free worker.
+    RESPONSE_CACHE_SIZE = 512  # Number of encoded responses kept, keyed by size.
+
+    # Every response for a given size is identical, so the encoded bytes are
+    # built once and reused. The cache is shared by all worker threads and kept
+    # in least-recently-used order so it stays bounded.
+    _resp_cache = collections.OrderedDict()
+    _resp_lock = threading.RLock()
+
     def __init__(self, host='0.0.0.0', port=8080):
         # Initialize the server with the given host and port.
         self.host = host
         self.port = port
+        # A fixed set of reused worker threads handles connections, which bounds
+        # resource usage and keeps thread creation off the accept path.
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix='web')
+        # The executor's queue is unbounded, so admission is capped with a
+        # semaphore; when it runs out, new connections wait in the kernel backlog.
+        self._slots = threading.BoundedSemaphore(self.MAX_WORKERS + self.MAX_QUEUED)
 
     def handle_client(self, client_socket):
-        # Handle an incoming client connection.
+        # Handle an incoming client connection. Clients that ask for keep-alive
+        # (such as the proxy's connection pool) can send several requests over
+        # the same connection; idle connections are closed after a timeout.
         try:
-            # Receive the HTTP request from the client.
-            request = client_socket.recv(1024).decode('utf-8')
-            logging.info(f"Request: {request}")
-
-            # Parse the HTTP request.
-            lines = request.splitlines()
-            if not lines:
-                return
-
-            request_line = lines[0]
-            method, uri, version = request_line.split()
-
-            if method != "GET":
-                # Respond with 501 Not Implemented if the method is not GET.
-                client_socket.sendall(b"HTTP/1.1 501 Not Implemented\r\n\r\n")
-                return
-
-            try:
-                # Extract the size from the URI and validate it.
-                size = int(uri.lstrip('/'))
-                if size < 100 or size > 20000:
-                    # Respond with 400 Bad Request if the size is out of range.
-                    client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
-                    return
-
-                # Generate the response content.
-                content = f"<HTML><BODY>{'a' * (size - 26)}</BODY></HTML>"
-                response = (
-                    f"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {len(content)}\r\n\r\n{content}"
-                )
-                # Send the response back to the client.
-                client_socket.sendall(response.encode('utf-8'))
-            except ValueError:
-                # Respond with 400 Bad Request if the size is not a valid integer.
-                client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            client_socket.settimeout(self.KEEP_ALIVE_TIMEOUT)
+            while self.handle_request(client_socket):
+                pass
+        except OSError:
+            # Idle timeout or the client went away.
+            pass
         finally:
             # Close the client socket.
             client_socket.close()
 
+    def connection_done(self, future):
+        # Called when handle_client finishes: free the connection's slot and log
+        # any unexpected error, which the Future would otherwise swallow.
+        self._slots.release()
+        exc = future.exception()
+        if exc is not None:
+            log.error("Error handling connection", exc_info=exc)
+
+    def handle_request(self, client_socket):
+        # Serve one request. Returns True if the connection should stay open.
+        # Receive the HTTP request from the client into a pooled buffer.
+        buf = acquire_buffer()
+        received = 0
+        try:
+            received = recv_request_head(client_socket, buf)
+            head = bytes(memoryview(buf)[:received])
+        finally:
+            release_buffer(buf, received)
+        if not head:
+            return False
+
+        # Parse the request line at the bytes level instead of decoding and
+        # splitting the whole request.
+        # Lines may end in CRLF or a bare LF.
+        line_end = head.find(b"\n")
+        request_line = (head[:line_end] if line_end >= 0 else head).rstrip(b"\r")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Request: %s", request_line.decode('latin-1'))
+
+        parsed = parse_request_line(request_line)
+        if parsed is None:
+            # Respond with 400 Bad Request if the request line is invalid.
+            client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            return False
+        method, uri, version, size = parsed
+
+        if method != b"GET":
+            # Respond with 501 Not Implemented if the method is not GET.
+            client_socket.sendall(b"HTTP/1.1 501 Not Implemented\r\n\r\n")
+            return False
+
+        # Validate the size taken from the URI.
+        if size is None or size < 100 or size > 20000:
+            # Respond with 400 Bad Request if the size is not a valid integer or out of range.
+            client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            return False
+
+        # Send the response back to the client.
+        client_socket.sendall(self.get_response(size))
+
+        # Error responses carry no Content-Length, so only successful responses
+        # can be followed by another request on the same connection.
+        return b"\r\nconnection: keep-alive\r\n" in head.lower()
+
+    def get_response(self, size):
+        # Return the encoded response for a document of the given size, building
+        # and caching it on first use.
+        with self._resp_lock:
+            response = self._resp_cache.get(size)
+            if response is not None:
+                self._resp_cache.move_to_end(size)
+                return response
+
+        # Generate the response content outside the lock; two threads may build
+        # the same response at once, but they produce identical bytes.
+        # The body is built directly as bytes, so there's no str-to-bytes encode.
+        content = b"<HTML><BODY>" + b"a" * (size - 26) + b"</BODY></HTML>"
+        response = (
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n" % len(content)
+        ) + content
+
+        with self._resp_lock:
+            self._resp_cache[size] = response
+            if len(self._resp_cache) > self.RESPONSE_CACHE_SIZE:
+                self._resp_cache.popitem(last=False)
+        return response
+
     def start(self):
         # Start the web server and listen for incoming connections.
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket = socket.socket(socket.AF_INET, LISTEN_SOCKET_TYPE)
+        tune_socket(server_socket)  # Set before listen() so accepted sockets inherit it.
         server_socket.bind((self.host, self.port))
-        server_socket.listen(5)
-        logging.info(f"Server running on {self.host}:{self.port}")
+        # A deep accept backlog keeps connection bursts queued in the kernel.
+        server_socket.listen(socket.SOMAXCONN)
+        log.info("Server running on %s:%d", self.host, self.port)
 
         try:
             while True:
-                # Accept a client connection.
+                # Wait for a free slot, then accept a client connection.
+                self._slots.acquire()
                 client_socket, _ = server_socket.accept()
-                # Handle the client connection in a separate thread.
-                threading.Thread(target=self.handle_client, args=(client_socket,)).start()
+                tune_socket(client_socket)
+                # Handle the client connection on a worker thread.
+                future = self._pool.submit(self.handle_client, client_socket)
+                future.add_done_callback(self.connection_done)
         finally:
             # Close the server socket.
             server_socket.close()
+            self._pool.shutdown(wait=False)
 
 if __name__ == "__main__":
     # Create and start the web server.